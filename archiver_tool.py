@@ -1,12 +1,25 @@
-from datetime import datetime
-from math import log10, ceil
-from pytz import timezone
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
 from argparse import ArgumentParser, FileType, ArgumentTypeError
 import requests
-import json
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import aiohttp
+import numpy as np
+try:
+    from orjson import dumps as json_dumps, loads as json_loads
+except ImportError:
+    import json
+    from json import loads as json_loads
+
+    def json_dumps(obj):
+        return json.dumps(obj).encode()
 import asyncio
-from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
+from itertools import chain
 import re
+import sys
 import logging
 
 BASEURL = 'http://control.maxiv.lu.se/general/archiving/'
@@ -30,8 +43,18 @@ CONTROLURL_LIST = {
         'species':     "b-v-species-csdb-0.maxiv.lu.se:10000",
         'veritas':     "b-v-veritas-csdb-0.maxiv.lu.se:10000",
         }
-UTC = timezone('UTC')
-CET = timezone('CET')
+JSON_HEADERS = {'Content-Type': 'application/json'}
+CHUNK_ROWS = 1 << 16
+INTERVAL_RE = re.compile(r'\d+(?:\.\d+)?[smhd]$')
+UTC = ZoneInfo('UTC')
+CET = ZoneInfo('Europe/Stockholm')
+
+SESSION = requests.Session()
+SESSION.mount('http://', HTTPAdapter(
+        pool_connections=32,
+        pool_maxsize=32,
+        max_retries=Retry(total=3, backoff_factor=0.2),
+        ))
 
 def makesearchpayload(searchterm):
     return {
@@ -39,120 +62,321 @@ def makesearchpayload(searchterm):
             'cs': CONTROLURL,
             }
 
-def makequerypayload(signal, start, end, interval):
-    start_naive = datetime.strptime(start, "%Y-%m-%dT%H:%M:%S")
-    end_naive = datetime.strptime(end, "%Y-%m-%dT%H:%M:%S")
-    start_cet = CET.localize(start_naive)
-    end_cet = CET.localize(end_naive)
-    start_utc = start_cet.astimezone(UTC)
-    end_utc = end_cet.astimezone(UTC)
+def cet_utcoffset(naive):
+    """
+    The UTC offset of a naive CET wall-clock time. A time that is ambiguous
+    or skipped when the clocks change is taken as standard time, as pytz's
+    localize did.
+    """
+    return min(CET.utcoffset(naive), CET.utcoffset(naive.replace(fold=1)))
+
+def utc_isoformat(local):
+    """
+    Convert an ISO-format CET wall-clock time to a UTC ISO-format string by
+    subtracting its UTC offset, rather than by full timezone conversion
+    """
+    naive = datetime.fromisoformat(local)
+    if naive.tzinfo is not None:
+        raise ValueError('Expected a CET time with no UTC offset', local)
+    return (naive - cet_utcoffset(naive)).replace(tzinfo=UTC).isoformat()
+
+def makequerypayload_batch(signals, start, end, interval):
+    cs = CONTROLURL
     return {
-            'targets': [{'target': signal, 'cs': CONTROLURL,}],
+            'targets': [{'target': sig, 'cs': cs} for sig in signals],
             'range': {
-                'from': start_utc.isoformat(),
-                'to': end_utc.isoformat(),
+                'from': utc_isoformat(start),
+                'to': utc_isoformat(end),
                 },
             'interval': interval
             }
 
-def parse_response(resp):
-    if not resp.status_code == 200:
-        data = {
-                'target': resp.text,
+def makequerypayload(signal, start, end, interval):
+    return makequerypayload_batch([signal], start, end, interval)
+
+def makequeryhead(start, end, interval):
+    """
+    The JSON encoding of a query payload without its targets or closing
+    brace, to be shared by every batch of signals in a request
+    """
+    payload = makequerypayload_batch([], start, end, interval)
+    del payload['targets']
+    return json_dumps(payload)[:-1]
+
+def encodequerybatch(head, signals):
+    cs = CONTROLURL
+    targets = json_dumps([{'target': sig, 'cs': cs} for sig in signals])
+    return head + b',"targets":' + targets + b'}'
+
+def local_offset(timestamp_ms):
+    """The local UTC-offset, in ms, of an epoch-millisecond timestamp"""
+    local = datetime.fromtimestamp(timestamp_ms / 1000, UTC).astimezone()
+    return local.utcoffset() // timedelta(milliseconds=1)
+
+def local_offsets(timestamps_ms):
+    """
+    The local UTC-offset, in ms, of each epoch-millisecond timestamp.
+    Offsets are looked up once per distinct quarter-hour in the data rather
+    than once per timestamp; only in a quarter-hour whose offset changes
+    part-way through, which is rare and never happens in zones that change
+    on the quarter-hour, is each timestamp looked up on its own.
+    """
+    step = 15 * 60 * 1000
+    quarters, index = np.unique(timestamps_ms // step, return_inverse=True)
+    starts = [local_offset(q * step) for q in quarters.tolist()]
+    ends = [local_offset(q * step + step - 1) for q in quarters.tolist()]
+    starts = np.asarray(starts, dtype='int64')
+    offsets = starts[index]
+    changing = (starts != np.asarray(ends, dtype='int64'))[index]
+    if changing.any():
+        offsets[changing] = [
+                local_offset(t) for t in timestamps_ms[changing].tolist()
+                ]
+    return offsets
+
+def local_datetimes(timestamps_ms):
+    """
+    Convert epoch-millisecond timestamps to local-time datetime64[ms]
+    """
+    ts = np.asarray(timestamps_ms, dtype='int64')
+    return (ts + local_offsets(ts)).astype('datetime64[ms]')
+
+def format_timestamps(timestamps_ms):
+    """
+    Format epoch-millisecond timestamps as local-time strings of the form
+    2021-01-31_05:00:00.000000, as a single vectorised operation
+    """
+    local = local_datetimes(timestamps_ms)
+    timestamps = np.datetime_as_string(local, unit='us')
+    chars = timestamps.view('U1').reshape(len(local), timestamps.itemsize // 4)
+    chars[:, 10] = '_'
+    return timestamps
+
+def decode_response(resp, count=1):
+    """
+    Decode a query response into one dataset per queried target.
+    A failed query gives an empty dataset for each of its targets, whose
+    target is the error text returned by the server. A successful response
+    that does not hold exactly count datasets raises a ValueError, since
+    its datasets cannot be matched to their targets.
+    """
+    status, body = resp
+    if not status == 200:
+        error = {
+                'target': body.decode(errors='replace'),
                 'datapoints': [],
                 }
-    else:
-        data = json.loads(resp.text)[0]
-    output = []
+        return [error] * count
+    datasets = json_loads(body)
+    if not len(datasets) == count:
+        raise ValueError(
+                'Expected {} datasets, got {}'.format(count, len(datasets))
+                )
+    return datasets
+
+def target_signal(target):
+    """The signal name of a dataset's target, without its control system"""
+    prefix = CONTROLURL + '/'
+    if target.startswith(prefix):
+        return target[len(prefix):]
+    return target
+
+def order_datasets(datasets, signals):
+    """
+    Match the datasets of a query to its signals by their targets, and
+    return them in the order of the signals. A ValueError is raised if any
+    signal does not have exactly one dataset.
+    """
+    by_signal = {}
+    for data in datasets:
+        sig = target_signal(data['target'])
+        if sig in by_signal:
+            raise ValueError('More than one dataset for', sig)
+        by_signal[sig] = data
+    missing = [sig for sig in signals if sig not in by_signal]
+    if missing:
+        raise ValueError('No dataset for', missing)
+    return [by_signal[sig] for sig in signals]
+
+def parse_response(data, raw=False):
+    """
+    Parse a dataset.
+    By default this returns the .dat file for the dataset as an iterable
+    of bytes: the two header lines, then the data rows in contiguous chunks
+    of up to CHUNK_ROWS rows.
+    If raw is True, it instead returns a tuple of the local timestamps, as
+    datetime64[ms], and the values, as float64, each in a NumPy array.
+    """
+    if raw:
+        datapoints = data['datapoints']
+        timestamps = local_datetimes([vals[1] for vals in datapoints])
+        values = np.asarray([vals[0] for vals in datapoints], dtype='float64')
+        return timestamps, values
+    return format_response(data)
+
+def format_response(data):
     target_str = data['target'].replace(CONTROLURL+'/', CONTROLURL+'//')
     datetime_str = datetime.isoformat(datetime.now(), sep=':')
-    output.append('"# DATASET= tango://' + target_str + '"')
-    output.append('"# SNAPSHOT_TIME= ' + datetime_str + '"')
-    for vals in data['datapoints']:
-        dt = datetime.fromtimestamp(vals[1] / 1000) #, tz=CET)
-        timestamp = dt.strftime("%Y-%m-%d_%H:%M:%S.%f")
-        output.append('{} {}'.format(timestamp, vals[0]))
-    return '\n'.join(output) + '\n'
-
-def get_attributes(search_strs):
+    yield ('"# DATASET= tango://' + target_str + '"\n').encode()
+    yield ('"# SNAPSHOT_TIME= ' + datetime_str + '"\n').encode()
+    datapoints = data['datapoints']
+    timestamps = format_timestamps([vals[1] for vals in datapoints])
+    timestamps = timestamps.astype('S').tolist()
+    for first in range(0, len(datapoints), CHUNK_ROWS):
+        last = first + CHUNK_ROWS
+        rows = zip(timestamps[first:last], datapoints[first:last])
+        buf = bytearray()
+        for timestamp, vals in rows:
+            buf += timestamp
+            buf += b' '
+            buf += str(vals[0]).encode()
+            buf += b'\n'
+        yield buf
+
+def write_dataset(filename, data):
+    with open(filename, 'wb', buffering=1<<20) as f:
+        f.writelines(parse_response(data))
+
+def search_attributes(searchterm):
+    logger = logging.getLogger(__name__)
+    logger.info('Getting matching attribute names for "{}"'.format(searchterm))
+    search_payload = makesearchpayload(searchterm)
+    logger.info('Posting {} to {}'.format(search_payload, SEARCHURL))
+    search_resp = SESSION.post(SEARCHURL, json=search_payload)
+    return json_loads(search_resp.content)
+
+@lru_cache(maxsize=256)
+def cached_search_attributes(controlurl, searchterm):
+    """
+    As search_attributes, but remembers the matches for each search term.
+    The control system URL is part of the key so that a search made on one
+    database is never answered from the cache of another.
+    """
+    return tuple(search_attributes(searchterm))
+
+def get_attributes(search_strs, cache=True):
     logger = logging.getLogger(__name__)
     if isinstance(search_strs, str):
         search_strs = [search_strs]
-    attributes = []
-    for sig in search_strs:
-        logger.info('Getting matching attribute names for "{}"'.format(sig))
-        search_payload = makesearchpayload(sig)
-        logger.info('Posting {} to {}'.format(search_payload, SEARCHURL))
-        try:
-            search_resp = requests.post(SEARCHURL, json=search_payload)
-        except requests.exceptions.ConnectionError:
-            err_str = '''
-            Cannot reach {}. Make sure you are inside the MAX-IV firewall.
-            '''
-            raise ValueError(err_str.format(SEARCHURL))
-        attributes += json.loads(search_resp.text)
+    if cache:
+        search = partial(cached_search_attributes, CONTROLURL)
+    else:
+        search = search_attributes
+    workers = min(32, max(1, len(search_strs)))
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(search, search_strs))
+    except requests.exceptions.ConnectionError:
+        err_str = '''
+        Cannot reach {}. Make sure you are inside the MAX-IV firewall.
+        '''
+        raise ValueError(err_str.format(SEARCHURL))
+    attributes = list(chain.from_iterable(results))
     logger.info('Found the following attributes: {}'.format(attributes))
     return attributes
 
-@asyncio.coroutine
-def do_request(start, end, signals, interval):
+async def fetch_datasets(session, head, signals):
+    """
+    Query the archiver for a batch of signals and return one dataset per
+    signal, matched by target. If the batch fails, or its response cannot
+    be matched to its signals, each signal is queried on its own so that
+    one bad signal does not cost the rest of the batch their data.
+    """
     logger = logging.getLogger(__name__)
-    loop = asyncio.get_event_loop()
-    futures, responses = [], []
-    for sig in signals:
-        payload = makequerypayload(sig, start, end, interval)
-        logger.info('Submitting: {}'.format(payload))
-        futures.append(loop.run_in_executor(
-                None,
-                partial(requests.post, url=QUERYURL, json=payload),
-                ))
-    task_count = len(futures)
-    for i, fut in enumerate(futures):
-        logger.info(
-                'Waiting for query {} of {} to complete'.format(
-                    i+1,
-                    task_count
-                    )
+    payload = encodequerybatch(head, signals)
+    logger.info('Submitting: {}'.format(payload.decode()))
+    post = session.post(QUERYURL, data=payload, headers=JSON_HEADERS)
+    async with post as resp:
+        body = await resp.read()
+    if len(signals) == 1:
+        return decode_response((resp.status, body))
+    if resp.status == 200:
+        try:
+            datasets = decode_response((resp.status, body), len(signals))
+            return order_datasets(datasets, signals)
+        except ValueError as err:
+            logger.warning('Batch query failed: {}'.format(err))
+    else:
+        logger.warning('Batch query failed with status {}'.format(resp.status))
+    logger.info('Querying the {} signals one by one'.format(len(signals)))
+    results = await asyncio.gather(
+            *(fetch_datasets(session, head, [sig]) for sig in signals)
+            )
+    return list(chain.from_iterable(results))
+
+async def post_query(session, head, signals, num, task_count, first,
+                     handler=None):
+    logger = logging.getLogger(__name__)
+    datasets = await fetch_datasets(session, head, signals)
+    logger.info('Query {} of {} completed'.format(num, task_count))
+    if handler is not None:
+        return await asyncio.gather(
+                *(handler(first + j, data) for j, data in enumerate(datasets))
                 )
-        resp = yield from fut
-        responses.append(resp)
-        logger.info('Query {} of {} completed'.format(i+1, task_count))
-    return responses
+    return datasets
+
+async def do_request(start, end, signals, interval, handler=None,
+                     batch_size=16):
+    """
+    Query the archiver for all signals concurrently, batch_size signals
+    per request, and return one dataset per signal.
+    If a handler coroutine is given, it is awaited as
+    handler(index, dataset) as soon as each response arrives, so that work
+    on finished responses overlaps with the queries still in flight; its
+    return values are returned in place of the datasets.
+    """
+    logger = logging.getLogger(__name__)
+    batches = [
+            signals[i:i+batch_size]
+            for i in range(0, len(signals), batch_size)
+            ]
+    connector = aiohttp.TCPConnector(limit=64, keepalive_timeout=30)
+    timeout = aiohttp.ClientTimeout(total=None, sock_connect=30)
+    async with aiohttp.ClientSession(
+            connector=connector, timeout=timeout) as session:
+        task_count = len(batches)
+        tasks = []
+        head = makequeryhead(start, end, interval)
+        for i, batch in enumerate(batches):
+            tasks.append(post_query(
+                    session, head, batch, i+1, task_count,
+                    i*batch_size, handler,
+                    ))
+        logger.info('Waiting for {} queries to complete'.format(task_count))
+        results = await asyncio.gather(*tasks)
+    return list(chain.from_iterable(results))
 
 def sync_do_request(start, end, signals, interval):
+    head = makequeryhead(start, end, interval)
     responses = []
     for sig in signals:
-        payload = makequerypayload(sig, start, end, interval)
-        resp = requests.post(url=QUERYURL, json=payload)
-        responses.append(resp)
+        payload = encodequerybatch(head, [sig])
+        resp = SESSION.post(url=QUERYURL, data=payload, headers=JSON_HEADERS)
+        responses += decode_response((resp.status_code, resp.content))
     return responses
 
-def query(start, end, signals, interval='0.1s'):
-    attrs = get_attributes(signals)
+def query(start, end, signals, interval='0.1s', cache=True):
+    attrs = get_attributes(signals, cache)
     if len(attrs) == 0:
         raise ValueError('No attribute matching', signals)
     if not len(attrs) == 1:
         raise ValueError('Multiple attributes matched', attrs)
-    responses = sync_do_request(start, end, attrs, interval)
-    a = [parse_response(resp) for resp in responses]
-    datastr = a[0]
-    data, timestamp = [], []
-    for line in datastr.split('\n')[2:]:
-        split = line.split()
-        if len(split) < 2:
-            break
-        data.append(float(split[1]))
-        timestamp.append(datetime.strptime(split[0], "%Y-%m-%d_%H:%M:%S.%f"))
-    return (timestamp, data)
+    datasets = sync_do_request(start, end, attrs, interval)
+    return parse_response(datasets[0], raw=True)
 
 if __name__=="__main__":
     def interval_value(val):
-        if not re.match('\d+\.*\d*[smh]$', str(val)):
+        if not INTERVAL_RE.match(val):
             raise ArgumentTypeError(
                     'INTERVAL must be a number followed by s, m, h, or d'
                     )
         return val
 
+    def batch_size_value(val):
+        if not val.isdigit() or int(val) < 1:
+            raise ArgumentTypeError('BATCH_SIZE must be a positive integer')
+        return int(val)
+
     parser = ArgumentParser(
             description='Get data from HDB++ archiver',
             epilog='''
@@ -197,7 +421,15 @@ if __name__=="__main__":
             0.1s; i.e., as dense as possible.
             This should be written in the form of a number and a time-unit;
             e.g., "1s" to sample every second, "2m" to sample every two
-            minutes, "1h" to sample every hour, etc.
+            minutes, "1h" to sample every hour, "1d" to sample every day,
+            etc.
+            '''
+            )
+    parser.add_argument(
+            '-b', '--batch-size', type=batch_size_value, default=16,
+            help='''
+            Maximum number of signals to request from the archiver in a
+            single query. By default this is 16.
             '''
             )
     parser.add_argument(
@@ -230,23 +462,33 @@ if __name__=="__main__":
                 format='%(asctime)s - - %(levelname)s - %(message)s'
                 )
 
-    loop = asyncio.get_event_loop()
-
     logger.info(args.signal)
     attributes = get_attributes(args.signal)
     start, end, interval = args.start, args.end, args.interval
-    response = loop.run_until_complete(
-            do_request(start, end, attributes, interval)
-            )
     if args.file:
-        numfiles = len(attributes)
-        numdigits = ceil(log10(numfiles + 1))
-        for i, resp in enumerate(response):
-            filename = args.file + str(i+1).zfill(numdigits) + '.dat'
+        numdigits = len(str(len(attributes)))
+        filename_fmt = ('{}{:0' + str(numdigits) + 'd}.dat').format
+
+        executor = ThreadPoolExecutor(
+                max_workers=min(32, max(1, len(attributes)))
+                )
+
+        async def write_response(i, data):
+            filename = filename_fmt(args.file, i+1)
             logger.info('Writing to {}'.format(filename))
-            with open(filename, 'w') as f:
-                f.write(parse_response(resp))
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(executor, write_dataset, filename, data)
+
+        with executor:
+            asyncio.run(do_request(
+                    start, end, attributes, interval, write_response,
+                    args.batch_size,
+                    ))
     else:
-        for resp in response:
-            print(parse_response(resp))
+        datasets = asyncio.run(do_request(
+                start, end, attributes, interval, batch_size=args.batch_size,
+                ))
+        for data in datasets:
+            sys.stdout.buffer.writelines(parse_response(data))
+            sys.stdout.buffer.write(b'\n')
 
@@ -1,115 +1,220 @@
 from cassandra.cluster import Cluster
+from cassandra.concurrent import execute_concurrent_with_args
 from cassandra.policies import AddressTranslator
 from cassandra.policies import DCAwareRoundRobinPolicy
+from cassandra.protocol import NumpyProtocolHandler
+from cassandra.query import tuple_factory
 from datetime import datetime, timedelta, time
-from time import time as tic
 from itertools import chain
-from argparse import ArgumentParser, FileType, ArgumentTypeError
-from pytz import timezone
-import logging
+from functools import lru_cache
+from threading import Event, Lock
+import numpy as np
 
-UTC = timezone('UTC')
-CET = timezone('CET')
+# Rows per page; large enough that a day of data needs few round trips
+FETCH_SIZE = 20000
 
+DC_1 = ['172.16.2.69', '172.16.2.70', '172.16.2.71',]
+DC_2 = ['172.16.2.66', '172.16.2.67', '172.16.2.68']
 
-def parse_async_results(results):
-    result_sets = [res.result() for res in results]
-    return list(chain(*result_sets))
+# Blue to Green topology
+ADDR_MAP = {
+    # Old nodes, need ip translation
+    "172.16.2.31" : "10.0.107.93",
+    "172.16.2.32" : "10.0.107.94",
+    "172.16.2.33" : "10.0.107.95",
+    "172.16.2.34" : "10.0.107.96",
+    "172.16.2.50" : "10.0.107.98",
+    "172.16.2.51" : "10.0.107.99",
+    # New nodes, IP forwarding is configured on the network
+    "172.16.2.66" : "172.16.2.66",
+    "172.16.2.67" : "172.16.2.67",
+    "172.16.2.68" : "172.16.2.68",
+    "172.16.2.69" : "172.16.2.69",
+    "172.16.2.70" : "172.16.2.70",
+    "172.16.2.71" : "172.16.2.71",
+}
+
+
+# Simple Network mapper to resolve green and blue addresses
+class NetworkAdressTranslator(AddressTranslator):
+    def __init__(self, addr_map=None):
+        self.addr_map = addr_map
+
+    def translate(self, addr):
+        new_addr = self.addr_map.get(addr)
+        return new_addr
+
+
+@lru_cache(maxsize=1)
+def _get_cluster():
+    """
+    The HDB++ cluster, shared by all signals so that the connection pools
+    and prepared statements are reused between them.
+    """
+    # Convert cluster points to local network hosts
+    hosts = [ADDR_MAP[host] for host in DC_1 + DC_2]
+    translator = NetworkAdressTranslator(ADDR_MAP)
+    return Cluster(
+            hosts,
+            connect_timeout=1,
+            address_translator=translator,
+            load_balancing_policy=DCAwareRoundRobinPolicy(local_dc='DC1'),
+            )
+
+
+@lru_cache(maxsize=1)
+def _get_session():
+    """
+    The session on the HDB++ cluster, shared by all signals.
+    It is only connected on first use.
+    """
+    session = _get_cluster().connect('hdb')
+    session.row_factory = tuple_factory
+    session.default_fetch_size = FETCH_SIZE
+    return session
+
+
+@lru_cache(maxsize=1)
+def _get_numpy_session():
+    """
+    A session on the HDB++ cluster whose results are decoded straight
+    into NumPy arrays, one dict of column arrays per page.
+    This needs the driver's Cython extensions; without them this is
+    the ordinary session.
+    """
+    if NumpyProtocolHandler is None:
+        return _get_session()
+    session = _get_cluster().connect('hdb')
+    session.row_factory = tuple_factory
+    session.default_fetch_size = FETCH_SIZE
+    session.client_protocol_handler = NumpyProtocolHandler
+    return session
+
+
+class PageCollector:
+    """
+    Collects the result pages of several concurrent queries, in order,
+    from the driver's callbacks as they arrive.
+    Further pages are requested as soon as each page lands, so paging of
+    every query overlaps instead of happening one query at a time while
+    the results are iterated over.
+    """
+    def __init__(self, futures):
+        self.pages = [[] for _ in futures]
+        self.pending = len(futures)
+        self.error = None
+        self.lock = Lock()
+        self.done = Event()
+        if not futures:
+            self.done.set()
+        for i, future in enumerate(futures):
+            future.add_callbacks(
+                    callback=self.add_page, callback_args=(i, future),
+                    errback=self.set_error,
+                    )
+
+    def add_page(self, rows, i, future):
+        self.pages[i].append(rows)
+        if future.has_more_pages:
+            future.start_fetching_next_page()
+            return
+        with self.lock:
+            self.pending -= 1
+            if self.pending == 0:
+                self.done.set()
+
+    def set_error(self, exc):
+        self.error = exc
+        self.done.set()
+
+    def result(self):
+        """Wait for every page of every query, and return them in order"""
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        if len(self.pages) == 1:
+            return self.pages[0]
+        return list(chain.from_iterable(self.pages))
 
 
 class LowlevelSignal:
     """
     Represents a signal found in the HDB++ archiver.
-    Each instance of this class contains its own session, and so
-    can execute queries easily during its entire lifetime.
+    All instances of this class share a single session on the cluster,
+    and so can execute queries easily during their entire lifetime.
 
     This class should only be used when really low-level access
     to Cassandra is needed.  It will only work on the Green network.
     """
+    _CONF_QUERY = (
+            "SELECT att_conf_id, data_type FROM att_conf "
+            "WHERE att_name=? ALLOW FILTERING"
+            )
+    _DATA_QUERY_TPL = (
+            "SELECT toUnixTimestamp(data_time) AS data_time_ms, value_r "
+            "FROM att_%s WHERE att_conf_id=? AND period=? "
+            "AND data_time>? AND data_time<?"
+            )
+    _prepared = {}
+    _conf_rows = {}
+
     def __init__(self, signal):
         self.att = signal
-        self._att_id = None
-        self._datatype = None
-        DC_1 = ['172.16.2.69', '172.16.2.70', '172.16.2.71',]
-        DC_2 = ['172.16.2.66', '172.16.2.67', '172.16.2.68']
-
-        # Simple Network mapper to resolve green and blue addresses
-        class NetworkAdressTranslator(AddressTranslator):
-            def __init__(self, addr_map=None):
-                self.addr_map = addr_map
-
-            def translate(self, addr):
-                new_addr = self.addr_map.get(addr)
-                return new_addr
-
-        # Blue to Green topology
-        addr_map = {
-            # Old nodes, need ip translation
-            "172.16.2.31" : "10.0.107.93",
-            "172.16.2.32" : "10.0.107.94",
-            "172.16.2.33" : "10.0.107.95",
-            "172.16.2.34" : "10.0.107.96",
-            "172.16.2.50" : "10.0.107.98",
-            "172.16.2.51" : "10.0.107.99",
-            # New nodes, IP forwarding is configured on the network
-            "172.16.2.66" : "172.16.2.66",
-            "172.16.2.67" : "172.16.2.67",
-            "172.16.2.68" : "172.16.2.68",
-            "172.16.2.69" : "172.16.2.69",
-            "172.16.2.70" : "172.16.2.70",
-            "172.16.2.71" : "172.16.2.71",
-        }
-
-        # Convert cluster points to local network hosts
-        self.hdb_cluster = [addr_map[host] for host in DC_1 + DC_2]
-        self.translator = NetworkAdressTranslator(addr_map)
-
-        hosts = self.hdb_cluster
-        translator = self.translator
-        cluster = Cluster(
-                hosts,
-                connect_timeout=1,
-                address_translator=translator,
-                load_balancing_policy=DCAwareRoundRobinPolicy(local_dc='DC1'),
-                )
-        self.session = cluster.connect('hdb')
-        self.id_future = self.session.execute_async(self.conf_query)
-        self.datatype_future = self.session.execute_async(self.datatype_query)
+        self._conf_row = self._conf_rows.get(signal)
+        self._data_statement = None
+        self.session = _get_session()
+        self.conf_future = None
+        if self._conf_row is None:
+            self.conf_future = self.session.execute_async(
+                    self.prepare(self.conf_query).bind((signal,))
+                    )
+
+    @property
+    def conf_row(self):
+        """The att_conf row, with both ID and data-type, of this record"""
+        if self._conf_row is None:
+            result = self.conf_future.result()
+            self._conf_row = result[0]
+            self._conf_rows[self.att] = self._conf_row
+        return self._conf_row
 
     @property
     def att_id(self):
         """The attribute ID of this record in the archiver"""
-        if not self._att_id:
-            result = self.id_future.result()
-            self._att_id = result[0].att_conf_id
-        return self._att_id
+        return self.conf_row[0]
 
     @property
     def datatype(self):
         """The type of the date in the archiver"""
-        if not self._datatype:
-            result = self.datatype_future.result()
-            self._datatype = result[0].data_type
-        return self._datatype
+        return self.conf_row[1]
 
     @property
     def conf_query(self):
-        """The query that returns the attribute ID"""
-        query = "SELECT att_conf_id FROM att_conf "
-        query += "WHERE att_name='{}' ALLOW FILTERING"
-        return query.format(self.att)
+        """The query that returns the attribute ID and data-type"""
+        return self._CONF_QUERY
 
     @property
-    def datatype_query(self):
-        """The query that returns the data-type of the attribute"""
-        query = "SELECT data_type FROM att_conf "
-        query += "WHERE att_conf_id={} ALLOW FILTERING"
-        return query.format(self.att_id)
+    def data_statement(self):
+        """The prepared statement that returns the data for one period"""
+        if self._data_statement is None:
+            query = self._DATA_QUERY_TPL % self.datatype
+            self._data_statement = self.prepare(query)
+        return self._data_statement
 
-    def data_query(self, date, timerange):
+    def prepare(self, query):
+        """
+        Prepare the query, or reuse the statement if it has already been
+        prepared on this session
         """
-        Returns the query needed to return the data within the specified
-        timerange on the specified date.
+        key = (self.session, query)
+        if key not in self._prepared:
+            self._prepared[key] = self.session.prepare(query)
+        return self._prepared[key]
+
+    def bind_values(self, date, timerange):
+        """
+        Returns the values to bind to the data statement to return the
+        data within the specified timerange on the specified date.
         Note that both the date and timerange are always required, and that
         the timerange must be a 2-tuple of datetimes (not just times)
         That the date of the timerange objects matches the date input
@@ -123,33 +228,67 @@ class LowlevelSignal:
             end = datetime.combine(date, time(23, 59, 59))
         else:
             end = timerange[1]
-        query = "SELECT * from att_{} WHERE att_conf_id={} "
-        query += "and period='{}' and data_time>'{}' and data_time<'{}'"
-        query = query.format(self.datatype, self.att_id, date, start, end)
-        return query
+        return (self.att_id, str(date), start, end)
 
     def get_data(self, datetimerange):
-        """Synchronously request the data within this datetime-range"""
+        """
+        Synchronously request the data within this datetime-range.
+        The rows are (data_time_ms, value_r) tuples, where data_time_ms
+        is the time in milliseconds since the epoch.
+        """
         periods, timeranges = self.parse_datetimerange(datetimerange)
-        results = [self.session.execute(self.data_query(date=p, timerange=t))
-                for p, t in zip(periods, timeranges)]
-        return list(chain(*results))
+        params = [self.bind_values(p, t) for p, t in zip(periods, timeranges)]
+        results = execute_concurrent_with_args(
+                self.session,
+                self.data_statement,
+                params,
+                concurrency=min(32, len(params)),
+                results_generator=True,
+                )
+        return list(chain.from_iterable(rows for _, rows in results))
 
     def async_get_data(self, datetimerange):
-        """Asynchronously request the data within this datetime-range"""
+        """
+        Asynchronously request the data within this datetime-range.
+        The times, as UTC datetime64[ms], and values are returned as
+        NumPy arrays.
+        """
         periods, timeranges = self.parse_datetimerange(datetimerange)
-        resultsets = [self.session.execute_async(
-                            self.data_query(date=p, timerange=t)
-                            )
-                for p, t in zip(periods, timeranges)]
-        resultsets = [resultset.result() for resultset in resultsets]
-        data = []
-        t = []
-        for resultset in resultsets:
-            for row in resultset:
-                data.append(row.value_r)
-                t.append(row.data_time)
-        return t, data
+        session = _get_numpy_session()
+        statement = self.data_statement
+        # One query per day, as each period is a separate partition, and
+        # CQL batches cannot hold SELECTs to combine them
+        futures = [
+                session.execute_async(statement.bind(self.bind_values(p, t)))
+                for p, t in zip(periods, timeranges)
+                ]
+        pages = PageCollector(futures).result()
+        if NumpyProtocolHandler is None:
+            rows = list(chain.from_iterable(pages))
+            t = np.array([row[0] for row in rows], dtype='int64')
+            data = np.array([row[1] for row in rows])
+        elif not pages:
+            t, data = np.array([], dtype='int64'), np.array([])
+        else:
+            # The bigint column comes back as a masked array; its mask is
+            # never set, as data_time is part of the primary key
+            if len(pages) == 1:
+                # The usual short, single-day query: nothing to join
+                t = np.ma.getdata(pages[0]['data_time_ms'])
+                data = np.ma.asarray(pages[0]['value_r'])
+            else:
+                t = np.concatenate(
+                        [np.ma.getdata(page['data_time_ms']) for page in pages]
+                        )
+                data = np.ma.concatenate([page['value_r'] for page in pages])
+            if np.ma.is_masked(data):
+                # Values archived as null, e.g. with an error, stay None
+                mask = np.ma.getmaskarray(data)
+                data = data.data.astype(object)
+                data[mask] = None
+            else:
+                data = data.data
+        return t.astype('datetime64[ms]'), data
 
     def parse_datetimerange(self, datetimerange):
         """
@@ -158,42 +297,61 @@ class LowlevelSignal:
         """
         start = datetimerange[0]
         end = datetimerange[1]
+        if end < start:
+            raise ValueError(
+                    'End of time-range is before its start', datetimerange
+                    )
         if start.date() == end.date():
             # timerange doesn't cross midnight
             period = [start.date()]
             timeranges = [(start, end)]
             return period, timeranges
-        periods = []
-        runningdate = start.date()
-        periods.append(runningdate)
-        timeranges = [(start, None)]
-        while not runningdate == end.date():
-            runningdate += timedelta(days=1)
-            periods.append(runningdate)
-            timeranges.append((None, None))
+        n_days = (end.date() - start.date()).days + 1
+        periods = [start.date() + timedelta(days=i) for i in range(n_days)]
+        timeranges = [(None, None)] * n_days
+        timeranges[0] = (start, None)
         timeranges[-1] = (None, end)
         return periods, timeranges
 
+@lru_cache(maxsize=1024)
+def get_signal(att):
+    """
+    The LowlevelSignal for the named attribute, reused between calls so
+    that its att_conf lookup is only made once per attribute
+    """
+    return LowlevelSignal(att)
+
+def format_timestamps(timelist):
+    """
+    Format datetimes as strings of the form 2021-01-31_05:00:00.000000,
+    as a single vectorised operation
+    """
+    times = np.asarray(timelist, dtype='datetime64[us]')
+    timestamps = np.datetime_as_string(times, unit='us')
+    chars = timestamps.view('U1').reshape(len(times), timestamps.itemsize // 4)
+    chars[:, 10] = '_'
+    return timestamps
+
 def parse_response(signame, resp):
+    """Generate the lines, each ending in a newline, of the .dat file"""
     timelist = resp[0]
     datalist = resp[1]
-    output = []
     datetime_str = datetime.isoformat(datetime.now(), sep=':')
-    output.append('"# DATASET= tango://' + signame + '"')
-    output.append('"# SNAPSHOT_TIME= ' + datetime_str + '"')
-    for t,dat in zip(timelist, datalist):
-        timestamp = t.strftime("%Y-%m-%d_%H:%M:%S.%f")
-        output.append('{} {}'.format(timestamp, dat))
-    return '\n'.join(output) + '\n'
+    yield '"# DATASET= tango://' + signame + '"\n'
+    yield '"# SNAPSHOT_TIME= ' + datetime_str + '"\n'
+    timestamps = format_timestamps(timelist).tolist()
+    yield from map('%s %s\n'.__mod__, zip(timestamps, datalist))
 
 
 if __name__=="__main__":
-    def interval_value(val):
-        if not re.match('\d+\.*\d*[smh]$', str(val)):
-            raise ArgumentTypeError(
-                    'INTERVAL must be a number followed by s, m, h, or d'
-                    )
-        return val
+    # Only needed by the command-line tool, so not imported with the module
+    from argparse import ArgumentParser
+    from zoneinfo import ZoneInfo
+    import logging
+    import sys
+
+    UTC = ZoneInfo('UTC')
+    CET = ZoneInfo('Europe/Stockholm')
 
     parser = ArgumentParser(
             description='Low-level API to the HDB++ archiver',
@@ -236,12 +394,21 @@ if __name__=="__main__":
                 format='%(asctime)s - - %(levelname)s - %(message)s'
                 )
 
-    start_naive = datetime.strptime(args.start, "%Y-%m-%dT%H:%M:%S")
-    end_naive = datetime.strptime(args.end, "%Y-%m-%dT%H:%M:%S")
-    start_cet = CET.localize(start_naive)
-    end_cet = CET.localize(end_naive)
-    start_utc = start_cet.astimezone(UTC)
-    end_utc = end_cet.astimezone(UTC)
+    def cet_to_utc(local):
+        """
+        Convert an ISO-format CET wall-clock time to a UTC datetime. A time
+        that is ambiguous or skipped when the clocks change is taken as
+        standard time, as pytz's localize did.
+        """
+        naive = datetime.fromisoformat(local)
+        if naive.tzinfo is not None:
+            raise ValueError('Expected a CET time with no UTC offset', local)
+        later = naive.replace(fold=1)
+        offset = min(CET.utcoffset(naive), CET.utcoffset(later))
+        return (naive - offset).replace(tzinfo=UTC)
+
+    start_utc = cet_to_utc(args.start)
+    end_utc = cet_to_utc(args.end)
 
     att = args.signal
     a = LowlevelSignal(att)
@@ -251,9 +418,10 @@ if __name__=="__main__":
 
     if args.file:
         filename = args.file + '.dat'
-        with open(filename, 'w') as f:
-            f.write(resp)
+        with open(filename, 'w', buffering=1<<20) as f:
+            f.writelines(resp)
     else:
-        print(resp)
+        sys.stdout.writelines(resp)
+        print()
 
 